@@ -125,6 +125,14 @@ resource "aws_iam_role_policy" "custom" {
           "dynamodb:Scan"
         ],
         Resource = aws_dynamodb_table.docproc.arn
+      },
+      {
+        Effect   = "Allow",
+        Action   = [
+          "textract:StartDocumentTextDetection",
+          "textract:GetDocumentTextDetection"
+        ],
+        Resource = "*"
       }
     ]
   })
@@ -213,7 +221,8 @@ resource "aws_ecs_task_definition" "app" {
     }]
     environment = [
       { name = "DYNAMODB_TABLE_NAME", value = aws_dynamodb_table.docproc.name },
-      { name = "AWS_DEFAULT_REGION", value = "us-east-1" }
+      { name = "AWS_DEFAULT_REGION", value = "us-east-1" },
+      { name = "TEXTRACT_MIN_PAGES", value = "20" }
     ]
     logConfiguration = {
       logDriver = "awslogs"
@@ -1,33 +1,121 @@
 import os
+import asyncio
 import io
 import re
+import math
+import time
 import fitz
 import boto3
+import aioboto3
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
 import cv2
-import pytesseract
-import tempfile
+from tesserocr import PyTessBaseAPI, PSM, OEM
 import logging
-import requests
+import threading
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import numpy as np
 from PIL import Image
 from pyzbar.pyzbar import decode
 from bs4 import BeautifulSoup
 from datetime import datetime
 from decimal import Decimal
-from typing import List, Dict, Any, Optional
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, Optional, Iterator
+from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 
 # Setup
-app = FastAPI(title="Hybrid Document Processor", version="4.0.0")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # AWS setup
 AWS_REGION = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
 DYNAMODB_TABLE_NAME = os.getenv("DYNAMODB_TABLE_NAME", "document-processor-results")
-s3_client = boto3.client("s3", region_name=AWS_REGION)
-dynamodb = boto3.resource("dynamodb", region_name=AWS_REGION)
+
+# Shared by S3 and DynamoDB: enough pooled keep-alive connections for the worker threads,
+# with adaptive backoff when AWS throttles
+AWS_CLIENT_CONFIG = Config(
+    max_pool_connections=64,
+    retries={"mode": "adaptive", "max_attempts": 5},
+    tcp_keepalive=True
+)
+s3_client = boto3.client("s3", region_name=AWS_REGION, config=AWS_CLIENT_CONFIG)
+textract_client = boto3.client("textract", region_name=AWS_REGION, config=AWS_CLIENT_CONFIG)
+
+# PDFs with more pages than this lacking a text layer are OCR'd by Textract instead of local
+# Tesseract (0 disables)
+TEXTRACT_MIN_PAGES = int(os.getenv("TEXTRACT_MIN_PAGES", "0"))
+TEXTRACT_POLL_SECONDS = 2
+TEXTRACT_TIMEOUT_SECONDS = 600
+
+# DynamoDB is accessed asynchronously over a persistent connection pool opened in lifespan()
+aio_session = aioboto3.Session()
+dynamodb_table = None
+
+# Multipart download settings for large scanned documents
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=32,
+    io_chunksize=1024 * 1024,
+    use_threads=True
+)
+_s3_transfer = None
+_s3_transfer_lock = threading.Lock()
+
+# Pooled keep-alive HTTP session for QR link validation, opened in lifespan()
+QR_LINK_TIMEOUT = 10
+QR_LINK_MAX_CONNECTIONS = 20
+QR_LINK_MAX_BYTES = 2 * 1024 * 1024
+http_session: Optional[aiohttp.ClientSession] = None
+
+# Per-step progress of documents being processed by this instance (kept out of DynamoDB)
+processing_progress: Dict[str, str] = {}
+
+# Documents are queued by /process and picked up by this many workers (see lifespan());
+# each worker runs the blocking pipeline on its own thread. A Textract job holds its worker
+# for the whole job (up to TEXTRACT_TIMEOUT_SECONDS), so this many large scanned PDFs at
+# once stall the queue.
+DOCUMENT_WORKERS = int(os.getenv("DOCUMENT_WORKERS", "4"))
+document_executor = ThreadPoolExecutor(max_workers=DOCUMENT_WORKERS)
+document_queue: Optional[asyncio.Queue] = None
+accepting_documents = False
+
+# On shutdown, queued and in-flight documents get this long to finish (ECS stopTimeout is 30s);
+# whatever is left is marked failed so it does not stay pending forever
+SHUTDOWN_DRAIN_SECONDS = int(os.getenv("SHUTDOWN_DRAIN_SECONDS", "25"))
+# Set once the drain is over; pipelines still running on worker threads stop at the next page
+# or Textract poll instead of finishing documents that have already been marked failed
+shutdown_event = threading.Event()
+
+# Page-level worker pool (Tesseract and zbar release the GIL in native code)
+PAGE_WORKERS = os.cpu_count() or 1
+page_executor = ThreadPoolExecutor(max_workers=PAGE_WORKERS)
+# Rendered pages a document may have waiting on page_executor; bounds memory per document
+MAX_PAGES_IN_FLIGHT = 2 * PAGE_WORKERS
+# Parallelism comes from the page workers; like Tesseract (OMP_THREAD_LIMIT=1), each OpenCV
+# call stays on its own thread so the cores are not oversubscribed
+cv2.setNumThreads(1)
+cv2.setUseOptimized(True)
+
+# PDF render resolution; small-format pages (receipts etc.) get a higher floor
+PDF_RENDER_DPI = int(os.getenv("PDF_RENDER_DPI", "108"))
+SMALL_PAGE_DPI = 144
+SMALL_PAGE_WIDTH_PT = 500
+
+# PDF pages with more embedded text than this skip OCR entirely
+NATIVE_TEXT_MIN_CHARS = 100
+
+# QR decoding cost is linear in pixel count; larger pages are downscaled first
+QR_MAX_PIXELS = 2_000_000
+
+# cv2.QRCodeDetector and TessBaseAPI are not thread-safe, so each page worker keeps its own
+_thread_state = threading.local()
+_tess_apis: List[PyTessBaseAPI] = []
+_tess_apis_lock = threading.Lock()
 
 # ----------------------------- Models -----------------------------
 
@@ -66,219 +154,509 @@ class ProcessingResult(BaseModel):
 
 # -------------------------- Utilities ----------------------------
 
+CURRENCY_RE = re.compile(r"KSh|KES")
+
+# Each field is searched separately: labels with no value would otherwise swallow
+# the next label in a single alternation and lose that field
+INVOICE_NUMBER_RE = re.compile(r'INVOICE\s*(?:NO|NUMBER)[:\s]+([A-Z0-9/]+)', re.IGNORECASE)
+INVOICE_DATE_RE = re.compile(r'Date\s*:\s*([0-9]{2}/[0-9]{2}/[0-9]{4})')
+TOTAL_AMOUNT_RE = re.compile(r'Total\s*KSh\s*([\d,\.]+)')
+PURCHASE_ORDER_RE = re.compile(r'Purchase Order Number\s*[:\-]?\s*([A-Z0-9\-]+)', re.IGNORECASE)
+
 def convert_float_to_decimal(obj):
-    if isinstance(obj, list):
-        return [convert_float_to_decimal(i) for i in obj]
-    elif isinstance(obj, dict):
-        return {k: convert_float_to_decimal(v) for k, v in obj.items()}
-    elif isinstance(obj, float):
+    # Converts in place with an explicit stack instead of rebuilding every dict/list recursively
+    if isinstance(obj, float):
         return Decimal(str(obj))
-    else:
+    if not isinstance(obj, (dict, list)):
         return obj
 
+    stack = [obj]
+    while stack:
+        container = stack.pop()
+        items = container.items() if type(container) is dict else enumerate(container)
+        for key, value in items:
+            value_type = type(value)
+            if value_type is float:
+                container[key] = Decimal(str(value))
+            elif value_type is dict or value_type is list:
+                stack.append(value)
+    return obj
+
 def extract_invoice_fields(text: str) -> Dict[str, Any]:
-    def find(pattern, flags=0, group=1):
-        match = re.search(pattern, text, flags)
+    def find(pattern, group=1):
+        match = pattern.search(text)
         return match.group(group).strip() if match else "Not found"
 
     fields = {
-        "Invoice Number": find(r'INVOICE\s*(?:NO|NUMBER)[:\s]+([A-Z0-9/]+)', re.IGNORECASE),
-        "Invoice Date": find(r'Date\s*:\s*([0-9]{2}/[0-9]{2}/[0-9]{4})'),
-        "Total Amount Due": find(r'Total\s*KSh\s*([\d,\.]+)'),
-        "Currency": "KES" if "KSh" in text or "KES" in text else "Not found",
-        "Purchase Order Number": find(r'Purchase Order Number\s*[:\-]?\s*([A-Z0-9\-]+)', re.IGNORECASE)
+        "Invoice Number": find(INVOICE_NUMBER_RE),
+        "Invoice Date": find(INVOICE_DATE_RE),
+        "Total Amount Due": find(TOTAL_AMOUNT_RE),
+        "Currency": "KES" if CURRENCY_RE.search(text) else "Not found",
+        "Purchase Order Number": find(PURCHASE_ORDER_RE)
     }
     return fields
 
-def check_qr_links(qr_links: List[str], invoice_fields: Dict[str, Any]) -> tuple[List[str], List[str]]:
+def html_visible_text(html: bytes) -> str:
+    # Only rendered text counts: script/style bodies and attribute values (which often echo the
+    # QR URL itself) must not validate a link. lxml sniffs the encoding from the bytes itself.
+    soup = BeautifulSoup(html, "lxml")
+    for tag in soup(["script", "style", "noscript", "template"]):
+        tag.decompose()
+    return soup.get_text(" ", strip=True).lower()
+
+async def qr_link_matches(link: str, expected_invoice: str) -> bool:
+    # Bodies are capped; an invoice page that has not shown the number by then is not a match
+    body = bytearray()
+    async with http_session.get(link) as r:
+        async for chunk in r.content.iter_chunked(64 * 1024):
+            body += chunk
+            if len(body) >= QR_LINK_MAX_BYTES:
+                break
+    body = bytes(body[:QR_LINK_MAX_BYTES])
+    if not expected_invoice:
+        return False
+    # Parsed off the event loop; a raw substring test would also match inside markup
+    text = await asyncio.get_running_loop().run_in_executor(None, html_visible_text, body)
+    return expected_invoice in text
+
+async def check_qr_links(qr_links: List[str], invoice_fields: Dict[str, Any]) -> tuple[List[str], List[str]]:
     valid, invalid = [], []
     expected_invoice = invoice_fields.get("Invoice Number", "").lower()
 
-    for link in qr_links:
-        try:
-            r = requests.get(link, timeout=10)
-            text = BeautifulSoup(r.text, "html.parser").get_text(" ", strip=True).lower()
-            if expected_invoice and expected_invoice in text:
-                valid.append(link)
-            else:
-                invalid.append(link)
-        except Exception as e:
-            invalid.append(f"{link} - Error: {e}")
+    # All links are fetched concurrently; results are still collected in QR order
+    outcomes = await asyncio.gather(
+        *(qr_link_matches(link, expected_invoice) for link in qr_links),
+        return_exceptions=True
+    )
+    for link, outcome in zip(qr_links, outcomes):
+        if isinstance(outcome, Exception):
+            # aiohttp timeouts stringify to "", so keep the exception type alongside the message
+            invalid.append(f"{link} - Error: {outcome!r}")
+        elif outcome:
+            valid.append(link)
+        else:
+            invalid.append(link)
     return valid, invalid
 
-def extract_qr_codes(image: Image.Image, page_num: int) -> List[QRCode]:
-    gray = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2GRAY)
-    decoded = decode(gray)
-    result = []
-
-    for obj in decoded:
-        qr_data = obj.data.decode('utf-8')
-        x, y, w, h = obj.rect
-        result.append(QRCode(
+def get_qr_detector() -> cv2.QRCodeDetector:
+    detector = getattr(_thread_state, "qr_detector", None)
+    if detector is None:
+        detector = _thread_state.qr_detector = cv2.QRCodeDetector()
+    return detector
+
+def decode_qr_rects(gray: np.ndarray) -> tuple[List[tuple], bool]:
+    # Also reports whether OpenCV located any QR code, decoded or not; detection can succeed
+    # while decoding fails, in which case ok is False but points are still returned
+    rects = []
+    ok, decoded_info, points, _ = get_qr_detector().detectAndDecodeMulti(gray)
+    located = points is not None and len(points) > 0
+    if ok:
+        for qr_data, corners in zip(decoded_info, points):
+            if qr_data:
+                rects.append((qr_data, cv2.boundingRect(corners.astype(np.float32))))
+
+    # Fall back to zbar when OpenCV decodes nothing on the page
+    if not rects:
+        rects = [(obj.data.decode('utf-8', 'replace'), obj.rect) for obj in decode(gray)]
+    return rects, located
+
+def qr_retry_variants(
+    small: np.ndarray,
+    full: np.ndarray,
+    shrink: float
+) -> Iterator[tuple[np.ndarray, float]]:
+    # Copies of a page whose QR code was located but not decoded, built lazily in order of cost,
+    # each with its scale relative to the full page; small is full scaled down by shrink.
+    # A located code is already in normal polarity, so only contrast and resolution can help.
+    yield cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(small), shrink
+    # More pixels per module: use the full-resolution page rather than interpolating the
+    # downscaled copy, and only upscale pages that were never shrunk
+    if shrink < 1.0:
+        yield full, 1.0
+    else:
+        yield cv2.resize(full, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC), 2.0
+
+def extract_qr_codes(gray: np.ndarray, page_num: int) -> List[Dict[str, Any]]:
+    # Plain dicts here; they are validated into QRCode once, when ProcessingResult is built
+    h, w = gray.shape[:2]
+    shrink = 1.0
+    small = gray
+    if h * w > QR_MAX_PIXELS:
+        shrink = math.sqrt(QR_MAX_PIXELS / (h * w))
+        small = cv2.resize(gray, None, fx=shrink, fy=shrink, interpolation=cv2.INTER_AREA)
+
+    rects, located = decode_qr_rects(small)
+    scale = shrink
+    if not rects and located:
+        # Only pages with a QR code that was found but not decoded pay for the enhancement passes;
+        # pages without one (most invoice pages) cost a single detection pass
+        for variant, variant_scale in qr_retry_variants(small, gray, shrink):
+            rects, _ = decode_qr_rects(variant)
+            if rects:
+                scale = variant_scale
+                break
+
+    # Report positions in the coordinates of the original page
+    return [
+        {
+            "page": page_num,
+            "data": qr_data,
+            "position": {
+                "x": round(x / scale),
+                "y": round(y / scale),
+                "width": round(rw / scale),
+                "height": round(rh / scale)
+            }
+        }
+        for qr_data, (x, y, rw, rh) in rects
+    ]
+
+def binarize_for_ocr(gray: np.ndarray) -> np.ndarray:
+    # CLAHE evens out uneven scan lighting; Otsu then spares Tesseract its own thresholding pass
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    _, bw = cv2.threshold(clahe.apply(gray), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return bw
+
+def get_tess_api() -> PyTessBaseAPI:
+    # The language model stays loaded in-process instead of being reloaded per page
+    api = getattr(_thread_state, "tess_api", None)
+    if api is None:
+        api = _thread_state.tess_api = PyTessBaseAPI(psm=PSM.SINGLE_BLOCK, oem=OEM.DEFAULT)
+        with _tess_apis_lock:
+            _tess_apis.append(api)
+    return api
+
+def close_tess_apis():
+    with _tess_apis_lock:
+        for api in _tess_apis:
+            api.End()
+        _tess_apis.clear()
+
+def extract_text_ocr(gray: np.ndarray, page_num: int) -> OCRResult:
+    api = get_tess_api()
+    api.SetImage(Image.fromarray(binarize_for_ocr(gray)))
+    text = api.GetUTF8Text().strip()
+    avg_conf = api.MeanTextConf()
+
+    # Fields are already the right types, so per-page validation is skipped
+    return OCRResult.model_construct(page=page_num, text=text, confidence=round(float(avg_conf), 1))
+
+def page_zoom(page: fitz.Page) -> float:
+    dpi = SMALL_PAGE_DPI if page.rect.width < SMALL_PAGE_WIDTH_PT else PDF_RENDER_DPI
+    return dpi / 72
+
+def needs_textract(pdf_bytes: bytes) -> bool:
+    # Born-digital pages are read from their text layer anyway, so only pages without one count
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        if doc.page_count <= TEXTRACT_MIN_PAGES:
+            return False
+        pages_without_text = 0
+        for page in doc:
+            if len(page.get_text("text").strip()) <= NATIVE_TEXT_MIN_CHARS:
+                pages_without_text += 1
+                if pages_without_text > TEXTRACT_MIN_PAGES:
+                    return True
+    return False
+
+def textract_ocr_results(bucket: str, key: str) -> Dict[int, OCRResult]:
+    # Asynchronous Textract text detection on the S3 object; the worker thread waits for the job
+    job_id = textract_client.start_document_text_detection(
+        DocumentLocation={"S3Object": {"Bucket": bucket, "Name": key}}
+    )["JobId"]
+    logger.info(f"Started Textract job {job_id} for s3://{bucket}/{key}")
+
+    deadline = time.monotonic() + TEXTRACT_TIMEOUT_SECONDS
+    response = textract_client.get_document_text_detection(JobId=job_id)
+    while response["JobStatus"] == "IN_PROGRESS":
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Textract job {job_id} did not finish within {TEXTRACT_TIMEOUT_SECONDS}s")
+        if shutdown_event.wait(TEXTRACT_POLL_SECONDS):
+            raise RuntimeError(f"Service shut down while waiting for Textract job {job_id}")
+        response = textract_client.get_document_text_detection(JobId=job_id)
+    if response["JobStatus"] != "SUCCEEDED":
+        raise RuntimeError(f"Textract job {job_id} {response['JobStatus']}: {response.get('StatusMessage', '')}")
+
+    lines: Dict[int, List[str]] = {}
+    confidences: Dict[int, List[float]] = {}
+    while True:
+        for block in response["Blocks"]:
+            if block["BlockType"] == "LINE":
+                page_num = block.get("Page", 1)
+                lines.setdefault(page_num, []).append(block["Text"])
+                confidences.setdefault(page_num, []).append(block["Confidence"])
+        if "NextToken" not in response:
+            break
+        response = textract_client.get_document_text_detection(JobId=job_id, NextToken=response["NextToken"])
+
+    return {
+        page_num: OCRResult.model_construct(
             page=page_num,
-            data=qr_data,
-            position={"x": x, "y": y, "width": w, "height": h}
-        ))
-    return result
-
-def extract_text_ocr(image: Image.Image, page_num: int) -> OCRResult:
-    custom_config = r'--oem 3 --psm 6'
-    text = pytesseract.image_to_string(image, config=custom_config).strip()
-    
+            text="\n".join(page_lines),
+            confidence=round(sum(confidences[page_num]) / len(confidences[page_num]), 1)
+        )
+        for page_num, page_lines in lines.items()
+    }
+
+def iter_pdf_pages(
+    pdf_bytes: bytes,
+    page_texts: Optional[Dict[int, OCRResult]] = None
+) -> Iterator[tuple[int, np.ndarray, Optional[OCRResult]]]:
+    # Render one page at a time straight into a grayscale array; no PNG round-trip,
+    # no unused color channels, and no need to hold the whole document in memory.
+    # Pages whose text is already known (embedded text layer, or page_texts from Textract)
+    # yield it so local OCR can be skipped.
+    page_texts = page_texts or {}
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
     try:
-        data = pytesseract.image_to_data(image, output_type=pytesseract.Output.DICT, config=custom_config)
-        confidences = [int(conf) for conf in data['conf'] if conf != '-1']
-        avg_conf = sum(confidences) / len(confidences) if confidences else 0
-    except:
-        avg_conf = 0
-    
-    return OCRResult(page=page_num, text=text, confidence=round(avg_conf, 1))
-
-def convert_pdf_to_images(pdf_path: str, output_dir: str) -> List[str]:
-    image_paths = []
-    doc = fitz.open(pdf_path)
-    for i, page in enumerate(doc):
-        pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-        path = os.path.join(output_dir, f"page_{i + 1}.png")
-        pix.save(path)
-        image_paths.append(path)
-    return image_paths
+        for i, page in enumerate(doc):
+            native_text = page.get_text("text").strip()
+            if len(native_text) > NATIVE_TEXT_MIN_CHARS:
+                known_ocr = OCRResult.model_construct(page=i + 1, text=native_text, confidence=100.0)
+            else:
+                known_ocr = page_texts.get(i + 1)
+            zoom = page_zoom(page)
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+            image = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width)
+
+            # MuPDF otherwise keeps pixmaps and its font/image store alive across pages
+            del pix
+            fitz.TOOLS.store_shrink(100)
+
+            yield i + 1, image, known_ocr
+    finally:
+        doc.close()
+
+def load_image(image_bytes) -> np.ndarray:
+    # Decoded at full resolution for OCR; extract_qr_codes downscales its own copy if needed
+    image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError("Could not decode image")
+    return image
+
+def process_page(
+    gray: np.ndarray,
+    page_num: int,
+    known_ocr: Optional[OCRResult] = None
+) -> tuple[List[Dict[str, Any]], OCRResult]:
+    # The same grayscale page is shared by the QR detector and Tesseract
+    qr_codes = extract_qr_codes(gray, page_num)
+    if known_ocr is not None:
+        return qr_codes, known_ocr
+    return qr_codes, extract_text_ocr(gray, page_num)
+
+def get_s3_transfer():
+    # One TransferManager for the process so its thread pool is not rebuilt per download
+    global _s3_transfer
+    with _s3_transfer_lock:
+        if _s3_transfer is None:
+            _s3_transfer = create_transfer_manager(s3_client, TRANSFER_CONFIG)
+    return _s3_transfer
 
 # ----------------------- Background Processor ----------------------
 
-async def update_dynamodb(document_id: str, updates: Dict[str, Any]):
-    table = dynamodb.Table(DYNAMODB_TABLE_NAME)
-    
-    # Build expression parts
-    set_expressions = []
-    names = {}
-    values = {}
-    
-    # Debug logging
-    logger.info(f"Updating DynamoDB for document {document_id} with updates: {updates}")
-    
-    # Handle each update field
-    for k, v in updates.items():
-        if k == "status":
-            # Use ExpressionAttributeNames for reserved keyword 'status'
-            set_expressions.append("#status = :status")
-            names["#status"] = "status"
-            values[":status"] = v
-        else:
-            # Regular fields
-            set_expressions.append(f"{k} = :{k}")
-            values[f":{k}"] = v
-    
-    # Add last_updated timestamp
-    set_expressions.append("last_updated = :last_updated")
-    values[":last_updated"] = datetime.utcnow().isoformat()
-    
-    # Build final expression
-    expression = "SET " + ", ".join(set_expressions)
-    
-    # Debug logging
-    logger.info(f"UpdateExpression: {expression}")
-    logger.info(f"ExpressionAttributeNames: {names}")
-    logger.info(f"ExpressionAttributeValues keys: {list(values.keys())}")
-    
-    # Update item
-    update_params = {
-        "Key": {"id": document_id},
-        "UpdateExpression": expression,
-        "ExpressionAttributeValues": convert_float_to_decimal(values)
-    }
-    
-    # Only add ExpressionAttributeNames if we have any
-    if names:
-        update_params["ExpressionAttributeNames"] = names
-        logger.info("Added ExpressionAttributeNames to update_params")
-    else:
-        logger.info("No ExpressionAttributeNames needed")
-    
+# The only non-terminal-result write is a failure, so its expression is fixed
+FAILURE_UPDATE_EXPRESSION = (
+    "SET #status = :status, #error = :error, processed_date = :last_updated, last_updated = :last_updated"
+)
+
+async def mark_dynamodb_failed(document_id: str, error: str):
+    logger.info(f"Marking document {document_id} as failed in DynamoDB")
+    now = datetime.utcnow().isoformat()
     try:
-        table.update_item(**update_params)
+        await dynamodb_table.update_item(
+            Key={"id": document_id},
+            UpdateExpression=FAILURE_UPDATE_EXPRESSION,
+            ExpressionAttributeNames={"#status": "status", "#error": "error"},
+            ExpressionAttributeValues={":status": "failed", ":error": error, ":last_updated": now}
+        )
         logger.info(f"Successfully updated DynamoDB for document {document_id}")
     except Exception as e:
         logger.error(f"DynamoDB update failed for document {document_id}: {str(e)}")
         raise
 
-async def process_document_background(record: DynamoDBRecord):
+async def put_dynamodb_result(record: DynamoDBRecord, result: ProcessingResult):
+    # The final write replaces the whole item, so the original record attributes are carried over
+    dumped = result.model_dump(mode="python")
+    item = {
+        "id": record.document_id,
+        "bucket": record.bucket,
+        "key": record.key,
+        "file_type": record.file_type,
+        "status": dumped["status"],
+        "qr_codes": dumped["qr_codes"],
+        "ocr_results": dumped["ocr_results"],
+        "validation_score": dumped["validation_score"],
+        "validation_errors": dumped["errors"],
+        "processed_date": dumped["processed_date"],
+        "invoice_fields": dumped["invoice_fields"],
+        "validated_qr_links": dumped["validated_qr_links"],
+        "invalid_qr_links": dumped["invalid_qr_links"],
+        "last_updated": dumped["processed_date"]
+    }
+    if record.upload_date is not None:
+        item["upload_date"] = record.upload_date
+
     try:
-        await update_dynamodb(record.document_id, {"status": "processing", "current_step": "downloading"})
+        await dynamodb_table.put_item(Item=convert_float_to_decimal(item))
+        logger.info(f"Successfully stored result for document {record.document_id}")
+    except Exception as e:
+        logger.error(f"DynamoDB put failed for document {record.document_id}: {str(e)}")
+        raise
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            file_path = os.path.join(tmpdir, os.path.basename(record.key))
-            s3_client.download_file(record.bucket, record.key, file_path)
+def extract_document(record: DynamoDBRecord) -> tuple[List[Dict[str, Any]], List[OCRResult], Dict[str, Any]]:
+    # Blocking download/render/OCR work; runs on document_executor, off the event loop
+    processing_progress[record.document_id] = "downloading"
+
+    # Download straight into memory; the document never touches the filesystem
+    buf = io.BytesIO()
+    get_s3_transfer().download(record.bucket, record.key, buf).result()
+
+    processing_progress[record.document_id] = "extracting"
+    if record.file_type == "pdf":
+        pdf_bytes = buf.getvalue()
+        page_texts = None
+        if TEXTRACT_MIN_PAGES and needs_textract(pdf_bytes):
+            # Large scanned documents: OCR runs on AWS; pages are still rendered locally for QR detection
+            processing_progress[record.document_id] = "textract"
+            try:
+                page_texts = textract_ocr_results(record.bucket, record.key)
+            except Exception as e:
+                # Textract only offloads work; local Tesseract can still read every page
+                logger.warning(f"Textract failed for {record.document_id}, falling back to Tesseract: {e!r}")
+                page_texts = None
+            processing_progress[record.document_id] = "extracting"
+        pages = iter_pdf_pages(pdf_bytes, page_texts)
+    elif record.file_type == "image":
+        image = load_image(buf.getbuffer())
+        pages = iter([(1, image, None)])
+    else:
+        raise ValueError("Unsupported file type")
+
+    # Each page is submitted as soon as it is rendered, but rendering waits on the oldest
+    # page once MAX_PAGES_IN_FLIGHT are pending; results stay in page order
+    page_results = []
+    in_flight = deque()
+    for page_num, image, known_ocr in pages:
+        if shutdown_event.is_set():
+            raise RuntimeError("Service shut down before processing finished")
+        if len(in_flight) >= MAX_PAGES_IN_FLIGHT:
+            page_results.append(in_flight.popleft().result())
+        in_flight.append(page_executor.submit(process_page, image, page_num, known_ocr))
+    page_results += [f.result() for f in in_flight]
+
+    qr_codes, ocr_results = [], []
+    for page_qr_codes, ocr in page_results:
+        qr_codes += page_qr_codes
+        ocr_results.append(ocr)
+    all_text = "\n" + "\n".join(o.text for o in ocr_results)
+
+    return qr_codes, ocr_results, extract_invoice_fields(all_text)
 
-            if record.file_type == "pdf":
-                image_paths = convert_pdf_to_images(file_path, tmpdir)
-            elif record.file_type == "image":
-                image_paths = [file_path]
-            else:
-                raise ValueError("Unsupported file type")
-
-            qr_codes, ocr_results, all_text = [], [], ""
-            for i, path in enumerate(image_paths):
-                image = Image.open(path)
-                qr_codes += extract_qr_codes(image, i + 1)
-                ocr = extract_text_ocr(image, i + 1)
-                ocr_results.append(ocr)
-                all_text += "\n" + ocr.text
-
-            await update_dynamodb(record.document_id, {"current_step": "validating"})
-
-            invoice_fields = extract_invoice_fields(all_text)
-            qr_data_list = [qr.data for qr in qr_codes]
-            valid_links, invalid_links = check_qr_links(qr_data_list, invoice_fields)
-            score = 80 if invoice_fields.get("Invoice Number") != "Not found" else 40
-
-            result = ProcessingResult(
-                document_id=record.document_id,
-                status="completed" if score >= 50 else "failed",
-                qr_codes=qr_codes,
-                ocr_results=ocr_results,
-                validation_score=score,
-                errors=[] if score >= 50 else ["Missing Invoice Number"],
-                processed_date=datetime.utcnow().isoformat(),
-                invoice_fields=invoice_fields,
-                validated_qr_links=valid_links,
-                invalid_qr_links=invalid_links
-            )
-
-            await update_dynamodb(record.document_id, {
-                "status": result.status,
-                "qr_codes": [q.dict() for q in result.qr_codes],
-                "ocr_results": [o.dict() for o in result.ocr_results],
-                "validation_score": result.validation_score,
-                "validation_errors": result.errors,
-                "processed_date": result.processed_date,
-                "invoice_fields": result.invoice_fields,
-                "validated_qr_links": result.validated_qr_links,
-                "invalid_qr_links": result.invalid_qr_links
-            })
+async def process_document_background(record: DynamoDBRecord):
+    try:
+        loop = asyncio.get_running_loop()
+        qr_codes, ocr_results, invoice_fields = await loop.run_in_executor(
+            document_executor, extract_document, record
+        )
+
+        processing_progress[record.document_id] = "validating"
+        qr_data_list = [qr["data"] for qr in qr_codes]
+        valid_links, invalid_links = await check_qr_links(qr_data_list, invoice_fields)
+        score = 80 if invoice_fields.get("Invoice Number") != "Not found" else 40
+
+        result = ProcessingResult(
+            document_id=record.document_id,
+            status="completed" if score >= 50 else "failed",
+            qr_codes=qr_codes,
+            ocr_results=ocr_results,
+            validation_score=score,
+            errors=[] if score >= 50 else ["Missing Invoice Number"],
+            processed_date=datetime.utcnow().isoformat(),
+            invoice_fields=invoice_fields,
+            validated_qr_links=valid_links,
+            invalid_qr_links=invalid_links
+        )
+
+        await put_dynamodb_result(record, result)
 
     except Exception as e:
         logger.error(f"Error processing {record.document_id}: {e}")
-        await update_dynamodb(record.document_id, {
-            "status": "failed",
-            "error": str(e),
-            "processed_date": datetime.utcnow().isoformat()
-        })
+        await mark_dynamodb_failed(record.document_id, str(e))
+    finally:
+        processing_progress.pop(record.document_id, None)
+
+async def document_worker(queue: asyncio.Queue):
+    while True:
+        record = await queue.get()
+        try:
+            await process_document_background(record)
+        except Exception as e:
+            # Only reached if even the failure status update failed; keep the worker alive
+            logger.error(f"Worker could not record failure for {record.document_id}: {e}")
+        finally:
+            queue.task_done()
 
 # ----------------------------- API Routes -----------------------------
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global dynamodb_table, document_queue, http_session, accepting_documents
+    # Per-socket limits rather than a total, so time spent waiting for a pooled connection
+    # is not charged to the link (each link gets QR_LINK_TIMEOUT to connect and between reads)
+    http_timeout = aiohttp.ClientTimeout(sock_connect=QR_LINK_TIMEOUT, sock_read=QR_LINK_TIMEOUT)
+    http_connector = aiohttp.TCPConnector(limit=QR_LINK_MAX_CONNECTIONS)
+    async with aio_session.resource("dynamodb", region_name=AWS_REGION, config=AWS_CLIENT_CONFIG) as ddb:
+        async with aiohttp.ClientSession(timeout=http_timeout, connector=http_connector) as http:
+            dynamodb_table = await ddb.Table(DYNAMODB_TABLE_NAME)
+            http_session = http
+            document_queue = asyncio.Queue()
+            workers = [asyncio.create_task(document_worker(document_queue)) for _ in range(DOCUMENT_WORKERS)]
+            accepting_documents = True
+            yield
+
+            # Stop taking new work and let the queue drain before tearing anything down
+            accepting_documents = False
+            try:
+                await asyncio.wait_for(document_queue.join(), SHUTDOWN_DRAIN_SECONDS)
+            except asyncio.TimeoutError:
+                logger.warning(f"Shutdown drain timed out with {len(processing_progress)} documents unfinished")
+            unfinished = list(processing_progress)
+            shutdown_event.set()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            for document_id in unfinished:
+                try:
+                    await mark_dynamodb_failed(document_id, "Service shut down before processing finished")
+                except Exception:
+                    pass  # already logged by mark_dynamodb_failed
+
+    # Running pipelines must finish before the Tesseract APIs they use are ended
+    document_executor.shutdown(wait=True, cancel_futures=True)
+    page_executor.shutdown(wait=True, cancel_futures=True)
+    close_tess_apis()
+
+app = FastAPI(title="Hybrid Document Processor", version="4.0.0", lifespan=lifespan)
+
 @app.post("/process")
-async def process_document(request: ProcessingRequest, background_tasks: BackgroundTasks):
+async def process_document(request: ProcessingRequest):
     record = request.record
     if record.status != "pending":
         raise HTTPException(status_code=400, detail="Document status must be 'pending'")
-    background_tasks.add_task(process_document_background, record)
+    if not accepting_documents:
+        raise HTTPException(status_code=503, detail="Service is shutting down")
+    # Progress is tracked in memory until the single terminal DynamoDB write
+    processing_progress[record.document_id] = "queued"
+    document_queue.put_nowait(record)
     return {"message": "Processing started", "document_id": record.document_id}
 
 @app.get("/status/{document_id}")
 async def get_status(document_id: str):
-    table = dynamodb.Table(DYNAMODB_TABLE_NAME)
-    response = table.get_item(Key={"id": document_id})
+    # In-flight documents on this instance are answered from memory
+    if document_id in processing_progress:
+        return {"id": document_id, "status": "processing", "current_step": processing_progress[document_id]}
+
+    response = await dynamodb_table.get_item(Key={"id": document_id})
     if "Item" not in response:
         raise HTTPException(status_code=404, detail="Document not found")
     return response["Item"]
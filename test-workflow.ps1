@@ -111,24 +111,23 @@ catch {
 # Step 3: Wait for Lambda to trigger and processing to start
 Write-Log "Step 3: Waiting for Lambda to trigger processing..."
 Write-Log "Lambda should automatically trigger and call the /process endpoint"
-Start-Sleep -Seconds 5
 
-# Step 4: Check processing status
+# Step 4: Check processing status, polling right away and backing off from 1s up to 10s
 Write-Log "Step 4: Checking processing status..."
-for ($i = 1; $i -le 12; $i++) {
-    Write-Log "Checking status (attempt $i/12)..."
+$STATUS_TIMEOUT = 120
+$POLL_DELAY = 1
+$POLL_TIMER = [System.Diagnostics.Stopwatch]::StartNew()
+:poll for ($i = 1; ; $i++) {
+    $ELAPSED = [int]$POLL_TIMER.Elapsed.TotalSeconds
+    Write-Log "Checking status (attempt $i, ${ELAPSED}s elapsed)..."
     
     try {
         $KeyJson = @{ id = @{ S = $DOCUMENT_ID } } | ConvertTo-Json -Depth 2
         $RESPONSE = aws dynamodb get-item --region $AWS_REGION --table-name $DYNAMODB_TABLE --key $KeyJson --output json | ConvertFrom-Json
         
         $STATUS = $RESPONSE.Item.status.S
-        $CURRENT_STEP = $RESPONSE.Item.current_step.S
         
         Write-Log "Current status: $STATUS"
-        if ($CURRENT_STEP) {
-            Write-Log "Current step: $CURRENT_STEP"
-        }
         
         switch ($STATUS) {
             "completed" {
@@ -144,23 +143,18 @@ for ($i = 1; $i -le 12; $i++) {
                 Write-Log "QR codes found: $QR_COUNT"
                 
                 Write-Log "✅ Test completed successfully!"
-                break
+                break poll
             }
             "failed" {
                 Write-Warning-Log "❌ Processing failed"
                 $ERROR_MSG = if ($RESPONSE.Item.error.S) { $RESPONSE.Item.error.S } else { "No error message" }
                 Write-Warning-Log "Error: $ERROR_MSG"
-                break
-            }
-            "processing" {
-                Write-Log "🔄 Still processing..."
+                break poll
             }
             "pending" {
-                if ($i -le 3) {
-                    Write-Log "⏳ Still pending (Lambda may be starting up)..."
-                } else {
-                    Write-Warning-Log "⚠️  Still pending after $($i*10) seconds. Lambda may not have triggered."
-                }
+                # The service writes DynamoDB only once processing finishes; until then the item
+                # stays pending (live progress is served by $ALB_URL/status/$DOCUMENT_ID)
+                Write-Log "⏳ Still pending (queued or processing)..."
             }
             default {
                 Write-Warning-Log "Unknown status: $STATUS"
@@ -171,9 +165,12 @@ for ($i = 1; $i -le 12; $i++) {
         Write-Warning-Log "Failed to get status from DynamoDB: $_"
     }
     
-    if ($i -lt 12) {
-        Start-Sleep -Seconds 10
+    if ($ELAPSED + $POLL_DELAY -gt $STATUS_TIMEOUT) {
+        Write-Warning-Log "Gave up waiting for processing after $ELAPSED seconds"
+        break
     }
+    Start-Sleep -Seconds $POLL_DELAY
+    $POLL_DELAY = [Math]::Min($POLL_DELAY * 2, 10)
 }
 
 # Step 5: Test API endpoint directly
@@ -111,72 +111,44 @@ fi
 log "Step 3: Waiting for Lambda to trigger processing..."
 log "Lambda should automatically trigger and call the /process endpoint"
 
-sleep 5
-
-# Step 4: Check processing status
+# Step 4: Check processing status, polling right away and backing off from 1s up to 10s
 log "Step 4: Checking processing status..."
-for i in {1..12}; do
-    log "Checking status (attempt $i/12)..."
-    
-    # Get status from DynamoDB
-    STATUS=$(aws dynamodb get-item \
-        --region $AWS_REGION \
-        --table-name "$DYNAMODB_TABLE" \
-        --key "{\"id\": {\"S\": \"$DOCUMENT_ID\"}}" \
-        --query 'Item.status.S' \
-        --output text 2>/dev/null)
+STATUS_TIMEOUT=120
+POLL_DELAY=1
+POLL_START=$SECONDS
+i=0
+while true; do
+    i=$((i + 1))
+    ELAPSED=$((SECONDS - POLL_START))
+    log "Checking status (attempt $i, ${ELAPSED}s elapsed)..."
     
-    CURRENT_STEP=$(aws dynamodb get-item \
+    # Read every field the checks below need in a single get-item; the error message goes
+    # last so any tabs or spaces in it stay within that one field
+    ITEM=$(aws dynamodb get-item \
         --region $AWS_REGION \
         --table-name "$DYNAMODB_TABLE" \
         --key "{\"id\": {\"S\": \"$DOCUMENT_ID\"}}" \
-        --query 'Item.current_step.S' \
-        --output text 2>/dev/null)
+        --query '[Item.status.S, Item.validation_score.N, Item.processed_date.S, length(Item.qr_codes.L || `[]`), Item.error.S]' \
+        --output text 2>/dev/null) && GET_ITEM_STATUS=0 || GET_ITEM_STATUS=$?
+    IFS=$'\t' read -r STATUS VALIDATION_SCORE PROCESSED_DATE QR_COUNT ERROR_MSG <<< "$ITEM"
     
-    if [[ $? -eq 0 && "$STATUS" != "None" ]]; then
+    if [[ $GET_ITEM_STATUS -eq 0 && "$STATUS" != "None" ]]; then
         log "Current status: $STATUS"
-        if [[ "$CURRENT_STEP" != "None" && "$CURRENT_STEP" != "" ]]; then
-            log "Current step: $CURRENT_STEP"
-        fi
         
         case $STATUS in
             "completed")
                 log "✅ Processing completed successfully!"
                 
-                # Show results
-                VALIDATION_SCORE=$(aws dynamodb get-item \
-                    --region $AWS_REGION \
-                    --table-name "$DYNAMODB_TABLE" \
-                    --key "{\"id\": {\"S\": \"$DOCUMENT_ID\"}}" \
-                    --query 'Item.validation_score.N' \
-                    --output text 2>/dev/null)
-                
                 if [[ "$VALIDATION_SCORE" != "None" ]]; then
                     log "Validation score: $VALIDATION_SCORE"
                 fi
                 
-                # Get processed date
-                PROCESSED_DATE=$(aws dynamodb get-item \
-                    --region $AWS_REGION \
-                    --table-name "$DYNAMODB_TABLE" \
-                    --key "{\"id\": {\"S\": \"$DOCUMENT_ID\"}}" \
-                    --query 'Item.processed_date.S' \
-                    --output text 2>/dev/null)
-                
                 if [[ "$PROCESSED_DATE" != "None" ]]; then
                     log "Processed date: $PROCESSED_DATE"
                 fi
                 
-                # Check if there are QR codes
-                QR_CODES_RESPONSE=$(aws dynamodb get-item \
-                    --region $AWS_REGION \
-                    --table-name "$DYNAMODB_TABLE" \
-                    --key "{\"id\": {\"S\": \"$DOCUMENT_ID\"}}" \
-                    --query 'Item.qr_codes.L' \
-                    --output text 2>/dev/null)
-                
-                if [[ "$QR_CODES_RESPONSE" != "None" && "$QR_CODES_RESPONSE" != "" ]]; then
-                    log "QR codes found in document"
+                if [[ "$QR_COUNT" -gt 0 ]]; then
+                    log "QR codes found in document: $QR_COUNT"
                 else
                     log "No QR codes found"
                 fi
@@ -186,13 +158,6 @@ for i in {1..12}; do
                 ;;
             "failed")
                 warn "❌ Processing failed"
-                ERROR_MSG=$(aws dynamodb get-item \
-                    --region $AWS_REGION \
-                    --table-name "$DYNAMODB_TABLE" \
-                    --key "{\"id\": {\"S\": \"$DOCUMENT_ID\"}}" \
-                    --query 'Item.error.S' \
-                    --output text 2>/dev/null)
-                
                 if [[ "$ERROR_MSG" != "None" && "$ERROR_MSG" != "" ]]; then
                     warn "Error: $ERROR_MSG"
                 else
@@ -200,15 +165,10 @@ for i in {1..12}; do
                 fi
                 break
                 ;;
-            "processing")
-                log "🔄 Still processing..."
-                ;;
             "pending")
-                if [[ $i -le 3 ]]; then
-                    log "⏳ Still pending (Lambda may be starting up)..."
-                else
-                    warn "⚠️  Still pending after $((i*10)) seconds. Lambda may not have triggered."
-                fi
+                # The service writes DynamoDB only once processing finishes; until then the item
+                # stays pending (live progress is served by $ALB_URL/status/$DOCUMENT_ID)
+                log "⏳ Still pending (queued or processing)..."
                 ;;
             *)
                 warn "Unknown status: $STATUS"
@@ -218,9 +178,12 @@ for i in {1..12}; do
         warn "Failed to get status from DynamoDB"
     fi
     
-    if [[ $i -lt 12 ]]; then
-        sleep 10
+    if [[ $((ELAPSED + POLL_DELAY)) -gt $STATUS_TIMEOUT ]]; then
+        warn "Gave up waiting for processing after $ELAPSED seconds"
+        break
     fi
+    sleep $POLL_DELAY
+    POLL_DELAY=$((POLL_DELAY * 2 > 10 ? 10 : POLL_DELAY * 2))
 done
 
 # Step 5: Test API endpoint directly